@@ -3,15 +3,131 @@
 # https://stackoverflow.com/questions/42938149/opencv-feature-matching-multiple-objects
 
 import cv2
+import hashlib
+import os
 import numpy as np
-from sklearn.cluster import MeanShift, estimate_bandwidth
+from sklearn.cluster import DBSCAN, MeanShift, estimate_bandwidth
 from collections import namedtuple
 
 # Container for the result of a keypoint-finder
-KeypointSet = namedtuple('KeypointSet', ['image', 'keypoints', 'descriptors'])
+# `points` caches the keypoint locations as an (N,2) float32 array,
+# `corners` the image corners in the (4,1,2) layout of cv2.perspectiveTransform
+# and `norms_sq` the squared L2 norm of each (floating-point) descriptor,
+# computed only on request (see `with_norms`)
+KeypointSet = namedtuple('KeypointSet', ['image', 'keypoints', 'descriptors',
+                                         'points', 'corners', 'norms_sq'])
 
 __DEBUG__ = False  # Debug flag for verbose output
 
+# Robust homography estimator. The USAC methods (openCV >= 4.5) terminate
+# adaptively, so hopeless clusters fail fast. Fall back to RANSAC otherwise.
+HOMOGRAPHY_METHOD = getattr(cv2, 'USAC_MAGSAC', cv2.RANSAC)
+
+# Minimum extent (in pixels, along each axis) and minimum variance (in pixels^2,
+# along the minor principal axis) of matched points for a homography search
+MIN_POINT_SPAN = 5
+MIN_POINT_VARIANCE = 1.0
+
+
+def build_keypoint_set(image, keypoints, descriptors):
+    """
+        Builds a KeypointSet from the output of a keypoint finder, caching the
+        keypoint locations so that matched points can be looked up by index.
+        Descriptor norms are not computed, see `with_norms`.
+    """
+    # KeyPoint_convert unpacks the keypoint locations in native code
+    if len(keypoints) > 0:
+        points = cv2.KeyPoint_convert(keypoints).reshape(-1, 2)
+    else:
+        points = np.empty((0, 2), dtype=np.float32)
+    h = image.shape[0]
+    w = image.shape[1]
+    corners = np.float32([ [0, 0], [0, h-1], [w-1, h-1], [w-1, 0]]).reshape(-1, 1, 2)
+    return KeypointSet(image, keypoints, descriptors, points, corners, None)
+
+
+def with_norms(keypoint_set):
+    """
+        Returns a KeypointSet with the squared L2 norms of its descriptors
+        cached, for matching with `l2_cross_check_match`. Squared norms are
+        only meaningful for floating-point descriptors, for others (or if
+        already cached) the KeypointSet is returned unchanged.
+    """
+    descriptors = keypoint_set.descriptors
+    if keypoint_set.norms_sq is not None or descriptors is None or descriptors.dtype.kind != 'f':
+        return keypoint_set
+    return keypoint_set._replace(norms_sq=np.einsum('ij,ij->i', descriptors, descriptors))
+
+
+def quantize_descriptors(descriptors):
+    """
+        Converts floating-point descriptors to uint8, quartering their memory
+        footprint and allowing the integer distance kernels to be used in
+        matching. openCV's SIFT descriptors are already saturated to integers in
+        [0, 255], so for SIFT this conversion is lossless. Descriptors that are
+        already uint8 (e.g binary ORB descriptors) are returned unchanged.
+    """
+    if descriptors is None or descriptors.dtype == np.uint8:
+        return descriptors
+    return np.clip(np.rint(descriptors), 0, 255).astype(np.uint8)
+
+
+def rootsift_descriptors(descriptors):
+    """
+        Converts floating-point SIFT descriptors to quantized RootSIFT
+        descriptors: each descriptor is L1-normalised and square-rooted (so
+        that L2 distances between them correspond to the Hellinger kernel on the
+        original descriptors), then scaled and saturated to uint8. Descriptors
+        that are already uint8 are returned unchanged.
+    """
+    if descriptors is None or descriptors.dtype == np.uint8:
+        return descriptors
+    l1_norms = np.maximum(descriptors.sum(axis=1, keepdims=True), np.finfo(np.float32).eps)
+    return np.clip(np.sqrt(descriptors / l1_norms) * 512.0, 0, 255).astype(np.uint8)
+
+
+def match_indices(matches):
+    """
+        Returns the query and train indices of a list of openCV matches as a
+        pair of int32 arrays.
+    """
+    n_matches = len(matches)
+    query = np.fromiter((m.queryIdx for m in matches), dtype=np.int32, count=n_matches)
+    train = np.fromiter((m.trainIdx for m in matches), dtype=np.int32, count=n_matches)
+    return query, train
+
+
+def l2_cross_check_match(template, test):
+    """
+        Brute-force matches the floating-point descriptors of two KeypointSets
+        under the L2 norm, keeping only mutual nearest neighbours (equivalent to
+        a cross-checked cv2.BFMatcher). All pairwise distances are computed as
+        |a|^2 + |b|^2 - 2a.b with a single matrix product, reusing the squared
+        norms cached in the KeypointSets (see `with_norms`) where available.
+        Returns the matched template and test indices as a pair of int arrays.
+    """
+    template, test = with_norms(template), with_norms(test)
+    dists = template.norms_sq[:, None] + test.norms_sq[None, :] \
+          - 2*np.dot(template.descriptors, test.descriptors.T)
+    best_test     = dists.argmin(axis=1)  # Nearest test descriptor for each template descriptor
+    best_template = dists.argmin(axis=0)  # Nearest template descriptor for each test descriptor
+    template_idx, = np.where(best_template[best_test] == np.arange(len(best_test)))
+    return template_idx, best_test[template_idx]
+
+
+def median_match_distance(descriptors1, descriptors2, norm):
+    """
+        Computes the median distance (under the openCV norm `norm`) between
+        each descriptor in `descriptors1` and its nearest neighbour in
+        `descriptors2`. Returns infinity if either set is empty.
+    """
+    if descriptors1 is None or descriptors2 is None:
+        return np.inf
+    matches = cv2.BFMatcher(norm).match(descriptors1, descriptors2)
+    if len(matches) == 0:
+        return np.inf
+    return np.median([m.distance for m in matches])
+
 
 def find_and_plot_keypoints(image, finder):
     """
@@ -24,55 +140,206 @@ def find_and_plot_keypoints(image, finder):
     return keypoint_image, len(keypoints)
 
 
-def meanshift_keypoint_labels(keypoints, quantile):
+def keypoint_bandwidth(point_locations, quantile, image_shape=None):
+    """
+        Returns the clustering bandwidth for an (N,2) array of keypoint locations.
+        By default the bandwidth is estimated from the keypoints themselves with a
+        nearest-neighbour pass. If the shape of the image is provided, the
+        bandwidth is instead taken directly as the `quantile` fraction of the
+        image diagonal. If the estimate vanishes (with few keypoints, each point
+        can be its own only neighbour), the bandwidth spans all the keypoints,
+        so that they form a single cluster.
+    """
+    if image_shape is not None:
+        return quantile * np.hypot(image_shape[0], image_shape[1])
+    bandwidth = estimate_bandwidth(point_locations, quantile=quantile)
+    if bandwidth <= 0:
+        bandwidth = max(float(np.ptp(point_locations, axis=0).max()), 1.0)
+    return bandwidth
+
+
+def meanshift_keypoint_labels(keypoints, quantile, image_shape=None, n_jobs=None):
     """
         Determines the clustering (with meanshift) for a set of keypoints
         and a specified bandwidth quantile. Returns a list of labels for the keypoints,
         specifying which cluster they lie in, and the total number of clusters.
+        Optionally the image shape can be provided to fix the bandwidth from the
+        image dimensions (see `keypoint_bandwidth`). `n_jobs` is passed on to
+        sklearn's MeanShift, note that it runs its seeds in separate processes,
+        which for typical keypoint counts costs more than it saves.
     """
-    # Add points to list
-    point_locations = np.array([ kp.pt for kp in keypoints])
+    # Keypoint locations as an (N,2) array
+    point_locations = cv2.KeyPoint_convert(keypoints)
 
     # Compute mean-shift clusters
-    bandwidth = estimate_bandwidth(point_locations, quantile=quantile)
-    ms = MeanShift(bandwidth=bandwidth, bin_seeding=True, cluster_all=True)
+    bandwidth = keypoint_bandwidth(point_locations, quantile, image_shape)
+    ms = MeanShift(bandwidth=bandwidth, bin_seeding=True, cluster_all=True, n_jobs=n_jobs)
     ms.fit(point_locations)
 
-    return ms.labels_,  max(ms.labels_)+1
+    return ms.labels_, ms.labels_.max()+1
+
+
+def dbscan_keypoint_labels(keypoints, quantile, image_shape=None, min_samples=5):
+    """
+        Determines the clustering (with DBSCAN) for a set of keypoints. The
+        neighbourhood radius is determined in the same way as the mean-shift
+        bandwidth, from the specified quantile. Returns a list of labels for the
+        keypoints and the total number of clusters. Keypoints that are not part
+        of any dense region are labelled as noise with -1, and so belong to no
+        cluster.
+    """
+    # Keypoint locations as an (N,2) array
+    point_locations = cv2.KeyPoint_convert(keypoints)
+
+    # Compute DBSCAN clusters
+    eps = keypoint_bandwidth(point_locations, quantile, image_shape)
+    db = DBSCAN(eps=eps, min_samples=min_samples, algorithm='ball_tree', n_jobs=-1)
+    labels = db.fit_predict(point_locations)
+
+    return labels, labels.max()+1
+
+
+# Available keypoint clustering algorithms
+KEYPOINT_CLUSTERING = {
+    "meanshift": meanshift_keypoint_labels,
+    "dbscan": dbscan_keypoint_labels,
+}
+
+
+def save_keypoints(filename, keypoints, descriptors):
+    """
+        Saves the output of a keypoint finder to a .npz file, so that it can be
+        reloaded with `load_keypoints` rather than recomputed.
+    """
+    attributes = np.array([(kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response)
+                           for kp in keypoints], dtype=np.float32).reshape(-1, 5)
+    identifiers = np.array([(kp.octave, kp.class_id) for kp in keypoints],
+                           dtype=np.int32).reshape(-1, 2)
+    has_descriptors = descriptors is not None
+    if not has_descriptors:
+        descriptors = np.empty((0, 0), dtype=np.float32)
+    np.savez(filename, attributes=attributes, identifiers=identifiers,
+             descriptors=descriptors, has_descriptors=has_descriptors)
+
+
+def load_keypoints(filename):
+    """
+        Loads keypoints and descriptors saved with `save_keypoints`. Returns
+        them in the same form as the finder's `detectAndCompute`.
+    """
+    with np.load(filename) as data:
+        keypoints = tuple(cv2.KeyPoint(float(x), float(y), float(size), float(angle),
+                                       float(response), int(octave), int(class_id))
+                          for (x, y, size, angle, response), (octave, class_id)
+                          in zip(data['attributes'], data['identifiers']))
+        descriptors = data['descriptors'] if data['has_descriptors'] else None
+    return keypoints, descriptors
+
+
+def cached_detect_and_compute(image, finder, cache_dir, label=""):
+    """
+        Computes the keypoints and descriptors of an OpenCV image with a keypoint
+        finder, persisting the results in `cache_dir`. Cache files are keyed on
+        the finder type and an md5 hash of the image contents, with an optional
+        `label` prefix for readability. As the finder parameters are not part of
+        the key, the cache should be cleared when they are changed.
+    """
+    image = np.ascontiguousarray(image)
+    digest = hashlib.md5(image).hexdigest()
+    finder_name = finder.getDefaultName().split('.')[-1]
+    filename = os.path.join(cache_dir, "{}_{}_{}.npz".format(label, finder_name, digest))
+    if os.path.exists(filename):
+        return load_keypoints(filename)
+
+    keypoints, descriptors = finder.detectAndCompute(image, None)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_keypoints(filename, keypoints, descriptors)
+    return keypoints, descriptors
+
+
+def is_sift(finder):
+    """ Returns True if the openCV keypoint finder `finder` is SIFT """
+    return finder.getDefaultName().split('.')[-1] == 'SIFT'
+
+
+def sift_inverse_features(keypoints, descriptors):
+    """
+        Derives the SIFT keypoints and descriptors of the brightness-inverse of
+        an image from those of the image itself, without a second SIFT pass.
+
+        Inverting the brightness negates the difference-of-Gaussian response,
+        so the same extrema (and therefore keypoints) are found. It also negates
+        every gradient, turning the dominant orientation of each keypoint by
+        180 degrees. Relative to this rotated frame the gradient orientations
+        are unchanged, while the 4x4 grid of histogram cells is point-reflected
+        about the keypoint. The inverse descriptors are therefore a fixed
+        permutation of the original ones (up to floating-point rounding in
+        the orientation assignment).
+    """
+    inverse_keypoints = tuple(cv2.KeyPoint(kp.pt[0], kp.pt[1], kp.size, (kp.angle + 180) % 360,
+                                           kp.response, kp.octave, kp.class_id)
+                              for kp in keypoints)
+    if descriptors is None:
+        return inverse_keypoints, None
+    # Descriptor layout is (row, column, orientation) over a 4x4x8 histogram
+    cells = descriptors.reshape(-1, 4, 4, 8)
+    inverse_descriptors = np.ascontiguousarray(cells[:, ::-1, ::-1, :]).reshape(-1, 128)
+    return inverse_keypoints, inverse_descriptors
+
+
+def cluster_precomputed(keypoints, descriptors, quantile=0.02, image_shape=None):
+    """
+        Clusters a set of precomputed keypoints and their descriptors through
+        the MeanShift clustering algorithm. Returns a list of keypoint clusters
+        and a corresponding list of descriptor clusters. Optionally the image
+        shape can be provided to fix the bandwidth (see `keypoint_bandwidth`).
+    """
+    # Get cluster labels through meanshift clustering
+    labels, nclusters = meanshift_keypoint_labels(keypoints, quantile=quantile,
+                                                  image_shape=image_shape)
+
+    if nclusters == 0:
+        return [], []
+
+    # Sort point indices by cluster, and find where each cluster starts
+    order = np.argsort(labels, kind='stable')
+    starts = np.searchsorted(labels[order], np.arange(nclusters))
+    order = order[starts[0]:]  # Drop points belonging to no cluster
+    starts = starts[1:] - starts[0]
+
+    # Return list of clusters, containing the keypoints. Keypoints are
+    # gathered as plain lists, avoiding an intermediate object array.
+    ordered_keypoints = [keypoints[j] for j in order.tolist()]
+    bounds = [0] + starts.tolist() + [len(ordered_keypoints)]
+    kp_clusters = [ordered_keypoints[bounds[i]:bounds[i+1]] for i in range(nclusters)]
+    ds_clusters = np.split(descriptors[order], starts)
+
+    return kp_clusters, ds_clusters
 
 
-def meanshift_keypoint_clusters(image, finder, quantile=0.02):
+def meanshift_keypoint_clusters(image, finder, quantile=0.02, fixed_bandwidth=False):
     """
         Takes an OpenCV image and a keypoint finder. Generates the keypoints
         for the image, and clusters them through the MeanShift clustering
         algorith. Returns a list of keypoint clusters and a corresponding list
         of descriptor clusters. Optionally the quantile for the MS bandwidth
-        estimation can be specified.
+        estimation can be specified, and with `fixed_bandwidth` the bandwidth
+        is derived from the image dimensions rather than estimated.
     """
     # Compute keypoints and descriptors
     keypoints, descriptors = finder.detectAndCompute(image, None)
-    # Get cluster labels through meanshift clustering
-    labels, nclusters = meanshift_keypoint_labels(keypoints, quantile=quantile)
-
-    # Return list of clusters, containing the keypoints
-    kp_clusters = [None] * nclusters  # Keypoint clusters
-    ds_clusters = [None] * nclusters  # Descriptor clusters
-    keypoints = np.array(keypoints)  # To be able to use the output of 'where' as an index
-    for i in range(nclusters):
-        d, = np.where(labels == i)  # Point indices which are in cluster 'i'
-        kp_clusters[i] = keypoints[d]
-        ds_clusters[i] = descriptors[d]
-
-    return kp_clusters, ds_clusters
+    image_shape = image.shape if fixed_bandwidth else None
+    return cluster_precomputed(keypoints, descriptors, quantile, image_shape)
 
 
-def build_bounding_box(template, test, matches, MIN_INLIERS):
+def build_bounding_box(template_corners, src_pts, dst_pts, MIN_INLIERS):
     """
-        Given a template KeypointSet and a test KeypointSet along with
-        a set of matched keypoints (matches), this function computes a
-        homography transformation between the two pointsets. This is then used
-        to transform the bounding-box of the template image into the space of
-        the test image.
+        Given the corners of a template image (as cached in its KeypointSet)
+        along with the locations of matched keypoints in the template (src_pts)
+        and in the test image (dst_pts), this function computes a homography
+        transformation between the two pointsets. This is then used to
+        transform the bounding-box of the template image into the space of the
+        test image.
 
         This bounding-box is returned in a form suitable for drawing with cv2.polyLines.
 
@@ -80,11 +347,28 @@ def build_bounding_box(template, test, matches, MIN_INLIERS):
         MIN_INLIERS point matches that can be used to construct a 'good fit' homography.
     """
 
-    src_pts = np.float32([ template.keypoints[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
-    dst_pts = np.float32([ test.keypoints[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
+    # A homography needs at least four point correspondences, and at most
+    # every match can be an inlier
+    if len(src_pts) < 4:
+        return None
+    if MIN_INLIERS is not None and len(src_pts) < MIN_INLIERS:
+        return None
+
+    # Reject degenerate (coincident or colinear) destination points, for which
+    # no meaningful homography exists
+    dst_flat = dst_pts.reshape(-1, 2)
+    if np.ptp(dst_flat, axis=0).min() < MIN_POINT_SPAN:
+        return None
+    if np.linalg.eigvalsh(np.cov(dst_flat, rowvar=False))[0] < MIN_POINT_VARIANCE:
+        return None
 
     # Find the homography between source and destination points
-    M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 2)
+    M, mask = cv2.findHomography(src_pts, dst_pts, method=HOMOGRAPHY_METHOD,
+                                 ransacReprojThreshold=2.0, maxIters=500, confidence=0.99)
+
+    if M is None:
+        # No transformation found
+        return None
 
     if MIN_INLIERS is not None:
         # Get number of inliers: matches that fit the homography
@@ -93,16 +377,25 @@ def build_bounding_box(template, test, matches, MIN_INLIERS):
         if inlier_count < MIN_INLIERS:
             return None
 
-    if M is None:
-        # No transformation found
+    dst = cv2.perspectiveTransform(template_corners, M)
+    dst = dst.reshape(4, 2)  # Reshape back to list of points
+    return dst.astype(np.int32, copy=False)
+
+
+def matched_bounding_box(template, test, template_idx, test_idx, MIN_MATCHES, MIN_INLIERS):
+    """
+        Given a template and a test KeypointSet, along with the indices of their
+        matched keypoints (as int arrays of equal length), attempts to build the
+        bounding-box of the template in the test image with `build_bounding_box`.
+        Returns None if there are fewer than MIN_MATCHES matches, or if no
+        acceptable homography is found.
+    """
+    if len(template_idx) < MIN_MATCHES:
         return None
-    else:
-        h = template.image.shape[0]
-        w = template.image.shape[1]
-        pts = np.float32([ [0, 0], [0, h-1], [w-1, h-1], [w-1, 0]]).reshape(-1, 1, 2)
-        dst = cv2.perspectiveTransform(pts, M)
-        dst = dst.reshape(4, 2)  # Reshape back to list of points
-        return np.int32(dst)
+    # Get source and destination points for homography search
+    src_pts = template.points.take(template_idx, axis=0).reshape(-1, 1, 2)
+    dst_pts = test.points.take(test_idx, axis=0).reshape(-1, 1, 2)
+    return build_bounding_box(template.corners, src_pts, dst_pts, MIN_INLIERS)
 
 
 def get_matching_boundingbox(template, test, matcher, MIN_MATCHES, MIN_INLIERS):
@@ -112,7 +405,8 @@ def get_matching_boundingbox(template, test, matcher, MIN_MATCHES, MIN_INLIERS):
         Takes as arguments
             template:    A KeypointSet object referring to the template to be matched
             test:        A KeypointSet object referring to the test image for matching.
-            matcher:     The keypoint descriptors of the test image
+            matcher:     The openCV matcher to use. If None, the descriptors are
+                         matched with `l2_cross_check_match`.
             MIN_MATCHES: The minimum number of matches for an acceptable boundingbox
             MIN_INLIERS: The minimum number of inliers for an acceptable boundingbox
         Returns:
@@ -137,20 +431,19 @@ def get_matching_boundingbox(template, test, matcher, MIN_MATCHES, MIN_INLIERS):
             return None
 
     # Perform match
-    matches = matcher.match(template.descriptors, test.descriptors)
+    if matcher is None:
+        template_idx, test_idx = l2_cross_check_match(template, test)
+    else:
+        template_idx, test_idx = match_indices(matcher.match(template.descriptors, test.descriptors))
     if __DEBUG__ is True:
-        print(len(matches) / min(n_template, n_test), " matches found")
+        print(len(template_idx) / min(n_template, n_test), " matches found")
 
     # If there are sufficient matches, attempt to build a homography
-    if len(matches) >= MIN_MATCHES:
-        # Get source and destination points for homography search
-        bounding_box = build_bounding_box(template, test, matches, MIN_INLIERS)
-        if bounding_box is not None:
-            return bounding_box
+    return matched_bounding_box(template, test, template_idx, test_idx, MIN_MATCHES, MIN_INLIERS)
 
 
 def bruteforce_match_clusters(template_img, test_img, finder, norm,
-                              QUANTILE=0.02, MIN_MATCHES=10, MIN_INLIERS=None):
+                              QUANTILE=0.02, MIN_MATCHES=10, MIN_INLIERS=None, in_place=False):
     """
         This function attempts to locate all instances of the template image 'img1' in
         a test image 'img2', under affine transformation. This happens through several steps.
@@ -166,28 +459,35 @@ def bruteforce_match_clusters(template_img, test_img, finder, norm,
             QUANTILE: Sets the quantile used in mean-shift bandwidth approximator.
             MIN_MATCHES: Minimum number of succesful matches required between cluster and template.
             MIN_INLIERS: Minimum number of matches that fit the constructed homography.
+            in_place: Annotates `test_img` directly rather than a copy.
     """
 
     # Compute keypoints and descriptors for template image
     template_keypoints, template_descriptors = finder.detectAndCompute(template_img, None)
-    template = KeypointSet(template_img, template_keypoints, template_descriptors)
+    template = build_keypoint_set(template_img, template_keypoints, template_descriptors)
+    # Cache the template norms, as the template is matched to every cluster
+    template = with_norms(template)
 
     # Compute keypoint and descriptor clusters for target image
     kp_clusters, ds_clusters = meanshift_keypoint_clusters(test_img, finder, quantile=QUANTILE)
 
-    # Set up brute-force matcher
-    bf = cv2.BFMatcher(norm, crossCheck=True)
+    # Set up brute-force matcher. Floating-point descriptors under the L2 norm
+    # are matched directly with cached norms (see `l2_cross_check_match`).
+    if norm in (cv2.NORM_L2, cv2.NORM_L2SQR) and template.norms_sq is not None:
+        bf = None
+    else:
+        bf = cv2.BFMatcher(norm, crossCheck=True)
 
     # Find matching bounding-boxes
     match_bounding_boxes = []
     for ic in range(len(kp_clusters)):
-        cluster = KeypointSet(test_img, kp_clusters[ic], ds_clusters[ic])
+        cluster = build_keypoint_set(test_img, kp_clusters[ic], ds_clusters[ic])
         bounding_box = get_matching_boundingbox(template, cluster, bf, MIN_MATCHES, MIN_INLIERS)
         if bounding_box is not None:
             match_bounding_boxes.append(bounding_box)
 
     # Annotate image with bounding-boxes and return
-    annotated_image = test_img.copy()
-    for box in match_bounding_boxes:
-        cv2.polylines(annotated_image, [box], True, 255, 3, cv2.LINE_AA)
+    annotated_image = test_img if in_place else test_img.copy()
+    if len(match_bounding_boxes) > 0:
+        cv2.polylines(annotated_image, match_bounding_boxes, True, 255, 3, cv2.LINE_AA)
     return annotated_image
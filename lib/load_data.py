@@ -1,6 +1,8 @@
 #!python3
 import re
 import os
+import hashlib
+import cv2
 import pandas as pd
 import numpy as np
 from urllib.request import urlopen
@@ -14,6 +16,8 @@ webpage_url = "http://www-sop.inria.fr/members/Alexis.Joly/BelgaLogos/BelgaLogos
 # Annotation/metadata filename
 data_folder = "data"
 qset3_internal_and_local_gt_file = "qset3_internal_and_local.gt"
+# Binary (feather) cache of the parsed metadata, see `metadata_cache_filename`
+qset3_internal_and_local_cache_prefix = "qset3_internal_and_local"
 
 # Column names for metadata file
 qset3_internal_and_local_gt_headers = [
@@ -73,23 +77,45 @@ LOGO_TYPE = {
 }
 
 
+def metadata_cache_filename():
+    """ Returns the filename of the feather cache of the parsed metadata. The
+    filename includes a hash of the column schema and of LOGO_TYPE, so that
+    editing either invalidates the cache. """
+    dtypes = sorted((column, dtype.__name__)
+                    for column, dtype in qset3_internal_and_local_gt_dtypes.items())
+    schema = (qset3_internal_and_local_gt_headers, dtypes, sorted(LOGO_TYPE.items()))
+    digest = hashlib.md5(repr(schema).encode()).hexdigest()[:12]
+    return os.path.join(data_folder, qset3_internal_and_local_cache_prefix + "_" + digest + ".feather")
+
+
 def read_metadata():
-    """ Reads the BelgaLogos metadata/annotations file for a specific feature category """
+    """ Reads the BelgaLogos metadata/annotations file for a specific feature category.
+    The parsed metadata is cached in feather format (if pyarrow is available)
+    and read from the cache while it is newer than the annotations file. """
     filename = os.path.join(data_folder, qset3_internal_and_local_gt_file)
+    cache_filename = metadata_cache_filename()
+    if os.path.exists(cache_filename) and \
+       os.path.getmtime(cache_filename) >= os.path.getmtime(filename):
+        try:
+            return pd.read_feather(cache_filename)
+        except ImportError:
+            pass
+
     metadata = pd.read_csv(filename, sep='\t',
                            lineterminator='\n',
                            header=None,
                            names=qset3_internal_and_local_gt_headers,
                            dtype=qset3_internal_and_local_gt_dtypes)
     # Check for NULL entries in all columns
-    nulltest = metadata.isnull().any()
-    for field_is_null in nulltest:
-        if field_is_null:
-            assert "NULL entry in read_metadata"
+    assert not metadata.isnull().any().any(), "NULL entry in read_metadata"
     # Further annotate with brand category (e.g car, clothing)
-    category = metadata.apply(lambda row: LOGO_TYPE[row['brand']], axis=1)
-    metadata['category'] = category
+    metadata['category'] = metadata['brand'].map(LOGO_TYPE)
 
+    # Caching is skipped without pyarrow, or if data/ is not writable
+    try:
+        metadata.to_feather(cache_filename)
+    except (ImportError, OSError):
+        pass
     return metadata
 
 
@@ -151,15 +177,32 @@ def load_images(metadata):
 def load_bb_images(metadata):
     """
         Given a pandas DataFrame containing BelgaLogos metadata, return a
-        new DataFrame consisting of the corresponding images cropped to
-        their logo bounded-boxes.
+        new DataFrame consisting of the corresponding (RGB) images cropped to
+        their logo bounded-boxes. Each image file is decoded only once, and
+        the crops are copied out of it so that the full image is not kept in
+        memory. As with PIL's crop, each crop has the exact size of its
+        bounding-box, with any part lying outside the image filled in black.
     """
 
-    def load_bounding_box(row):
-        filename = os.path.join(data_folder, 'images', row['image_file'])
-        im = Image.open(filename).convert('RGB')
-        bb = im.crop((row['bbx1'], row['bby1'], row['bbx2'], row['bby2']))
-        return bb
-
-    images = metadata.apply(load_bounding_box, axis=1)
-    return images
+    def crop_bounding_box(im, x1, y1, x2, y2):
+        crop = np.zeros((max(y2 - y1, 0), max(x2 - x1, 0)) + im.shape[2:], dtype=im.dtype)
+        # Part of the bounding-box lying within the image
+        cx1, cy1 = max(x1, 0), max(y1, 0)
+        cx2, cy2 = min(x2, im.shape[1]), min(y2, im.shape[0])
+        if cx2 > cx1 and cy2 > cy1:
+            crop[cy1-y1:cy2-y1, cx1-x1:cx2-x1] = im[cy1:cy2, cx1:cx2]
+        return crop
+
+    bbx1, bby1 = metadata['bbx1'].to_numpy(), metadata['bby1'].to_numpy()
+    bbx2, bby2 = metadata['bbx2'].to_numpy(), metadata['bby2'].to_numpy()
+
+    images = np.empty(len(metadata), dtype=object)
+    for image_file, rows in metadata.groupby('image_file', sort=False).indices.items():
+        filename = os.path.join(data_folder, 'images', image_file)
+        im = cv2.imread(filename)
+        if im is None:
+            raise FileNotFoundError("Cannot read image file: " + filename)
+        im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+        for row in rows:
+            images[row] = crop_bounding_box(im, bbx1[row], bby1[row], bbx2[row], bby2[row])
+    return pd.Series(images, index=metadata.index)
@@ -1,15 +1,82 @@
 # A class implementing a keypoint-matching object detector for the BelgaLogos dataset.
 import lib.validation as validation
 import lib.keypoint_matching as kpm
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import numpy as np
 import cv2
+import os
+import threading
 
 # A container for detected objects
 DetectedObject = namedtuple("DetectedObject", ["label", "bounding_box"])
 
+# FLANN index algorithms (see flann/defines.h)
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH    = 6
+
+# Lowe's ratio for filtering ambiguous nearest-neighbour matches
+RATIO_TEST = 0.75
+# Number of nearest neighbours (over all templates) searched for each target
+# keypoint, from which the two nearest of each template are taken
+RATIO_NEIGHBOURS = 8
+# Minimum number of descriptors for a template to be indexed. The brute-force
+# (CPU and CUDA) matchers return invalid indices when any template in their
+# collection has fewer than RATIO_NEIGHBOURS descriptors, and templates with
+# fewer than the default MIN_MATCHES (10) descriptors cannot be matched anyway.
+MIN_TEMPLATE_DESCRIPTORS = max(RATIO_NEIGHBOURS, 10)
+
+
+def flann_matcher(norm):
+    """
+        Builds a FLANN-based descriptor matcher suitable for the openCV norm
+        `norm`. Binary descriptors (Hamming norms, e.g ORB) are indexed with
+        locality-sensitive hashing, floating-point descriptors (e.g SIFT) with
+        a forest of randomised KD-trees.
+    """
+    if norm in (cv2.NORM_HAMMING, cv2.NORM_HAMMING2):
+        index_params = dict(algorithm=FLANN_INDEX_LSH, table_number=6,
+                            key_size=12, multi_probe_level=1)
+    else:
+        index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
+    search_params = dict(checks=50)
+    return cv2.FlannBasedMatcher(index_params, search_params)
+
+
+def cpu_matcher(norm):
+    """
+        Builds a brute-force descriptor matcher running on the CPU. As for the
+        FLANN and CUDA matchers, distances are reported under NORM_L2 rather
+        than NORM_L2SQR, so that the ratio test has the same meaning for all.
+    """
+    if norm == cv2.NORM_L2SQR:
+        norm = cv2.NORM_L2
+    return cv2.BFMatcher(norm)
+
+
+def cuda_available():
+    """ Returns True if openCV was built with CUDA and a CUDA device is present """
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+
+def cuda_matcher(norm):
+    """
+        Builds a brute-force descriptor matcher running on the GPU. The CUDA
+        matcher does not support squared norms, so NORM_L2SQR is replaced by
+        the equivalent (for ranking purposes) NORM_L2.
+    """
+    if norm == cv2.NORM_L2SQR:
+        norm = cv2.NORM_L2
+    return cv2.cuda.DescriptorMatcher_createBFMatcher(norm)
+
 
 def annotate_image_with_objects(image, detected_objects,
-                                correct_match=None, text_colour=(0, 255, 255)):
+                                correct_match=None, text_colour=(0, 255, 255),
+                                in_place=False):
     """
         For an input image and a list of DetectedObject tuples,
         returns a new image annotating the image with the detection
@@ -21,6 +88,7 @@ def annotate_image_with_objects(image, detected_objects,
         rendered in red.
         `text_colour`, also an optional input, specified the desired colour
         of the annotating text.
+        `in_place`, if True, draws directly onto `image` rather than a copy.
     """
     if correct_match == None:
         correct_match = [True] * len(detected_objects)
@@ -32,30 +100,118 @@ def annotate_image_with_objects(image, detected_objects,
     font = cv2.FONT_HERSHEY_SIMPLEX
     font_size = 1
 
-    annotated_image = image.copy()
+    annotated_image = image if in_place else image.copy()
+
+    # Draw the bounding-boxes with one call per colour
+    boxes_by_match = defaultdict(list)
     for i, iobject in enumerate(detected_objects):
-        box_colour = colours[correct_match[i]]
+        boxes_by_match[correct_match[i]].append(iobject.bounding_box)
+    for match, boxes in boxes_by_match.items():
+        cv2.polylines(annotated_image, boxes, True, colours[match], 3, cv2.LINE_AA)
+
+    for iobject in detected_objects:
         bounding_box = iobject.bounding_box
         top_left_corner = (bounding_box[0][0], bounding_box[0][1]+20)
-        cv2.polylines(annotated_image, [bounding_box], True, box_colour, 3, cv2.LINE_AA)
         cv2.putText(annotated_image, iobject.label, top_left_corner,
                     font, font_size, text_colour, 3, cv2.LINE_AA)
     return annotated_image
 
 
 class KeypointMatcher:
-    def __init__(self, finder, norm):
+    def __init__(self, finder, norm, clustering="meanshift", fixed_bandwidth=False,
+                 quantize=False, inverse_threshold=None, cache_dir=None,
+                 ratio_test=RATIO_TEST, max_workers=None):
         """
             Constructor for the KeypointMatcher class, Takes as arguments an
             openCV keypoint finder (`finder`) and an openCV norm (`norm`) to be
-            used in the matching.
+            used in the matching. Optionally the algorithm used to cluster the
+            target keypoints (`clustering`) can be chosen from the keys of
+            `keypoint_matching.KEYPOINT_CLUSTERING`. If `fixed_bandwidth` is
+            True, the clustering bandwidth is derived from the target image
+            dimensions rather than estimated from its keypoints. If `quantize`
+            is True, floating-point descriptors are stored and matched as uint8
+            (see `keypoint_matching.quantize_descriptors`), if it is "rootsift"
+            they are also converted to RootSIFT (see
+            `keypoint_matching.rootsift_descriptors`). Quantized descriptors
+            are matched by brute-force on the CPU, templates with fewer than
+            MIN_TEMPLATE_DESCRIPTORS descriptors are then not indexed. If
+            `inverse_threshold` is given, brightness-inverse templates whose
+            descriptors lie within this median match distance (in units of
+            `norm`) of the original template are considered redundant, and
+            are not added to the model. If `cache_dir` is given, template
+            keypoints are cached on disk there and reused on later runs.
+            `ratio_test` sets the ratio used in Lowe's test for discarding
+            ambiguous matches. `max_workers` bounds the number of threads used
+            to process the clusters of a target image (by default, the CPU
+            count), with 1 they are processed serially.
         """
         self.finder = finder
         self.norm   = norm
-        self.matcher = cv2.BFMatcher(norm, crossCheck=True)
+        self.keypoint_labels = kpm.KEYPOINT_CLUSTERING[clustering]
+        self.fixed_bandwidth = fixed_bandwidth
+        self.quantize = quantize
+        self.inverse_threshold = inverse_threshold
+        self.cache_dir = cache_dir
+        self.ratio_test = ratio_test
+        self.max_workers = max_workers
+        # All templates are indexed jointly by a single matcher. Neither the
+        # FLANN KD-tree nor the CUDA L2 matcher accept integer descriptors, so
+        # quantized descriptors are matched by brute-force on the CPU.
+        # Otherwise a brute-force matcher on the GPU is used where available,
+        # FLANN elsewhere.
+        self.use_cuda = not quantize and cuda_available()
+        if quantize:
+            self.matcher = cpu_matcher(norm)
+        elif self.use_cuda:
+            self.matcher = cuda_matcher(norm)
+        else:
+            self.matcher = flann_matcher(norm)
         # Available categories
         self.templates = []
         self.labels = []
+        # Number of descriptors in each template
+        self.template_sizes = []
+        # Template index of each image added to the matcher
+        self.indexed_templates = []
+        # Whether the matcher has been trained on all added templates
+        self.trained = False
+        self._train_lock = threading.Lock()
+
+    def _compute_keypoint_set(self, label, image):
+        """ Computes (or loads from the disk cache) the KeypointSet of a template image """
+        if self.cache_dir is None:
+            kp, desc = self.finder.detectAndCompute(image, None)
+        else:
+            kp, desc = kpm.cached_detect_and_compute(image, self.finder, self.cache_dir, label)
+        desc = self._quantize(desc)
+        return kpm.build_keypoint_set(image, kp, desc)
+
+    def _quantize(self, descriptors):
+        """ Applies the model's descriptor quantization (if any) """
+        if self.quantize == "rootsift":
+            return kpm.rootsift_descriptors(descriptors)
+        if self.quantize:
+            return kpm.quantize_descriptors(descriptors)
+        return descriptors
+
+    def _add_keypoint_set(self, label, template):
+        """ Adds a template KeypointSet to the model and to the matcher """
+        self.templates.append(template)
+        self.labels.append(label)
+        self.template_sizes.append(0 if template.descriptors is None else len(template.descriptors))
+        # Templates with too few descriptors are not indexed
+        if self.template_sizes[-1] >= MIN_TEMPLATE_DESCRIPTORS:
+            self.matcher.add([self._to_device(template.descriptors)])
+            self.indexed_templates.append(len(self.templates) - 1)
+            self.trained = False
+
+    def _to_device(self, descriptors):
+        """ Uploads descriptors to the GPU when matching with CUDA """
+        if not self.use_cuda:
+            return descriptors
+        gpu_descriptors = cv2.cuda_GpuMat()
+        gpu_descriptors.upload(descriptors)
+        return gpu_descriptors
 
     def add_template(self, label, image):
         """
@@ -67,59 +223,291 @@ class KeypointMatcher:
             image.
         """
         # Find template keypoints
-        kp, desc = self.finder.detectAndCompute(image, None)
-        template = kpm.KeypointSet(image, kp, desc)
-        self.templates.append(template)
-        self.labels.append(label)
-        # Find template inverse keypoints
+        template = self._compute_keypoint_set(label, image)
+        self._add_keypoint_set(label, template)
+        # Find template inverse keypoints. For SIFT these follow directly
+        # from the keypoints of the template.
         inverse_image = cv2.bitwise_not(image)
-        kp, desc = self.finder.detectAndCompute(inverse_image, None)
-        template = kpm.KeypointSet(inverse_image, kp, desc)
-        self.templates.append(template)
-        self.labels.append(label)
+        if kpm.is_sift(self.finder):
+            kp, desc = kpm.sift_inverse_features(template.keypoints, template.descriptors)
+            inverse_template = kpm.build_keypoint_set(inverse_image, kp, desc)
+        else:
+            inverse_template = self._compute_keypoint_set(label, inverse_image)
+        # Skip the inverse template if it adds no discriminating information
+        if self.inverse_threshold is not None:
+            distance = kpm.median_match_distance(template.descriptors,
+                                                 inverse_template.descriptors, self.norm)
+            if distance < self.inverse_threshold:
+                return
+        self._add_keypoint_set(label, inverse_template)
+
+    def train(self):
+        """
+            Builds the matcher index over all templates added so far. This is
+            done once, rather than implicitly by the matcher on the next query,
+            so that the index is not rebuilt per query and is never built
+            concurrently by several detection threads. Called automatically
+            by `detect_objects` if templates have been added since the last
+            training.
+        """
+        with self._train_lock:
+            if not self.trained:
+                if len(self.indexed_templates) > 0:
+                    self.matcher.train()
+                self.trained = True
+
+    def match_templates(self, target):
+        """
+            Matches the descriptors of a KeypointSet against all templates with
+            a single matcher query. Ambiguous matches are removed with Lowe's
+            ratio test, applied separately for each template: the nearest
+            neighbour in a template is compared to the second-nearest in the
+            same template, so that similar (or duplicated) templates do not
+            suppress each other's matches. Returns four arrays giving, for each
+            surviving match, the index of the target keypoint, the index of the
+            matched template keypoint, the index of the matched template and
+            the match distance.
+        """
+        target_idx, template_kp_idx, image_idx, distance = [], [], [], []
+        n_indexed = sum(self.template_sizes[i] for i in self.indexed_templates)
+        # The ratio test needs at least two neighbours
+        if target.descriptors is not None and n_indexed >= 2:
+            query = self._to_device(target.descriptors)
+            k = min(RATIO_NEIGHBOURS, n_indexed)
+            for neighbours in self.matcher.knnMatch(query, k=k):
+                # LSH may return fewer than two neighbours
+                if len(neighbours) < 2:
+                    continue
+                # Nearest and second-nearest neighbour in each template. When a
+                # template's second-nearest is not among the neighbours found,
+                # the furthest neighbour is a lower bound on its distance.
+                nearest, second_distance = {}, {}
+                for neighbour in neighbours:
+                    if neighbour.imgIdx not in nearest:
+                        nearest[neighbour.imgIdx] = neighbour
+                    elif neighbour.imgIdx not in second_distance:
+                        second_distance[neighbour.imgIdx] = neighbour.distance
+                bound = neighbours[-1].distance
+                for img, best in nearest.items():
+                    if best.distance < self.ratio_test*second_distance.get(img, bound):
+                        target_idx.append(best.queryIdx)
+                        template_kp_idx.append(best.trainIdx)
+                        image_idx.append(img)
+                        distance.append(best.distance)
 
-    def verify_non_overlapping(self, detected_objects, new_object):
+        # Convert matcher image indices to template indices
+        indexed_templates = np.array(self.indexed_templates, dtype=np.int32)
+        template_idx = indexed_templates[np.array(image_idx, dtype=np.int32)]
+        return (np.array(target_idx, dtype=np.int32),
+                np.array(template_kp_idx, dtype=np.int32),
+                template_idx,
+                np.array(distance, dtype=np.float32))
+
+    def verify_non_overlapping(self, aabbs, areas, new_aabb):
         """
             Ensure that the bb of a new object does not significantly
-            overlap the bb of an existing object.
+            overlap the bb of an existing object. Existing objects are given by
+            their axis-aligned bounding-boxes as an (N,4) array `aabbs` of
+            [x1, y1, x2, y2] rows, along with their `areas`.
          """
-        AABB1 = validation.vertices_to_AABB(new_object.bounding_box)
-        for iobject in detected_objects:
-            AABB2 = validation.vertices_to_AABB(iobject.bounding_box)
-            overlap = validation.compute_rectangle_intersection(AABB1, AABB2)
-            area2 = validation.compute_rectangle_area(AABB2)
-            # New bounding-box overlaps more than 50% of an existing one.
-            if overlap > 0.5*area2:
-                return False
-        return True
-
-    def detect_objects(self, target_image):
+        olx = np.maximum(0, np.minimum(aabbs[:, 2], new_aabb[2]) - np.maximum(aabbs[:, 0], new_aabb[0]))
+        oly = np.maximum(0, np.minimum(aabbs[:, 3], new_aabb[3]) - np.maximum(aabbs[:, 1], new_aabb[1]))
+        overlap = olx * oly
+        # New bounding-box overlaps more than 50% of an existing one.
+        return bool(np.all(overlap <= 0.5*areas))
+
+    def cluster_candidates(self, target, matches, MIN_MATCHES, MIN_INLIERS):
+        """
+            Given the target KeypointSet and the matches (as returned by
+            `match_templates`) of a single target cluster, attempts to build a
+            bounding-box for each template. Returns the list of candidate
+            `DetectedObject`s in template order.
+        """
+        target_idx, template_kp_idx, template_idx, distance = matches
+        candidates = []
+        # Only templates with at least MIN_MATCHES matches in the cluster, and
+        # at least MIN_MATCHES descriptors to be matched, can yield a
+        # bounding-box. The others are skipped without further work.
+        match_counts = np.bincount(template_idx, minlength=len(self.templates))
+        eligible = (match_counts >= MIN_MATCHES) & (np.asarray(self.template_sizes) >= MIN_MATCHES)
+        # Loop over trained samples
+        for il in np.flatnonzero(eligible):
+            matched = np.flatnonzero(template_idx == il)
+            # Keep only the closest match to each template keypoint. Many-to-one
+            # matches collapse onto a single source point and degrade the homography.
+            matched = matched[np.argsort(distance[matched], kind='stable')]
+            _, unique = np.unique(template_kp_idx[matched], return_index=True)
+            matched = matched[unique]
+            # Attempt to determine a matched-bounding box on the target image
+            bounding_box = kpm.matched_bounding_box(self.templates[il], target,
+                                                    template_kp_idx[matched], target_idx[matched],
+                                                    MIN_MATCHES, MIN_INLIERS)
+            if bounding_box is not None:
+                candidates.append(DetectedObject(self.labels[il], bounding_box))
+        return candidates
+
+    def detect_objects(self, target_image, QUANTILE=0.02, MIN_MATCHES=10, MIN_INLIERS=10,
+                       max_workers=None):
         """
             Detect objects in a target image. Takes as input only an openCV
             image, in which the template objects are to be detected. Returns a
-            list of `DetectedObject` containers.
+            list of `DetectedObject` containers. `max_workers`, if given,
+            overrides the model's bound on the threads processing the clusters
+            of the image (e.g 1 when images are already processed in parallel).
+        """
+        # Compute the keypoints of the target image
+        keypoints, descriptors = self.finder.detectAndCompute(target_image, None)
+        return self.detect_objects_precomputed(target_image, keypoints, descriptors,
+                                               QUANTILE, MIN_MATCHES, MIN_INLIERS, max_workers)
+
+    def detect_objects_batch(self, target_images, QUANTILE=0.02, MIN_MATCHES=10, MIN_INLIERS=10):
+        """
+            Detect objects in a sequence of openCV images. Returns a list
+            containing the list of `DetectedObject`s for each image.
+
+            The images are processed as a pipeline: while one image is being
+            clustered and matched, the keypoints of the next image are computed
+            in a background thread. `target_images` may be any iterable (e.g a
+            generator reading images from disk).
+        """
+        detected_objects = []
+        with ThreadPoolExecutor(max_workers=1) as extractor:
+            previous = None
+            for target_image in target_images:
+                # Start computing the keypoints of this image
+                keypoints = extractor.submit(self.finder.detectAndCompute, target_image, None)
+                # Meanwhile, detect objects in the previous image
+                if previous is not None:
+                    detected_objects.append(self.detect_objects_precomputed(
+                        previous[0], *previous[1].result(),
+                        QUANTILE=QUANTILE, MIN_MATCHES=MIN_MATCHES, MIN_INLIERS=MIN_INLIERS))
+                previous = (target_image, keypoints)
+            if previous is not None:
+                detected_objects.append(self.detect_objects_precomputed(
+                    previous[0], *previous[1].result(),
+                    QUANTILE=QUANTILE, MIN_MATCHES=MIN_MATCHES, MIN_INLIERS=MIN_INLIERS))
+        return detected_objects
+
+    def detect_objects_precomputed(self, target_image, keypoints, descriptors,
+                                   QUANTILE=0.02, MIN_MATCHES=10, MIN_INLIERS=10,
+                                   max_workers=None):
         """
+            As `detect_objects`, but takes the keypoints and descriptors of the
+            target image as already computed with the model's finder. This
+            allows several models (with equivalent finders) to be evaluated
+            on an image while computing its keypoints only once.
+        """
+        if descriptors is None:
+            return []
+        descriptors = self._quantize(descriptors)
+        target = kpm.build_keypoint_set(target_image, keypoints, descriptors)
+        if not self.trained:
+            self.train()
+
         # Determine the clusters in the target image
-        kp_clusters, ds_clusters = kpm.meanshift_keypoint_clusters(target_image, self.finder)
-        n_clusters = len(kp_clusters)
-        n_labels = len(self.labels)
+        image_shape = target_image.shape if self.fixed_bandwidth else None
+        cluster_labels, n_clusters = self.keypoint_labels(keypoints, quantile=QUANTILE,
+                                                          image_shape=image_shape)
+
+        # Match all target keypoints against all trained samples at once, the
+        # matches are then partitioned by cluster.
+        matches = self.match_templates(target)
+        match_clusters = cluster_labels[matches[0]]
+
+        # Clusters with fewer keypoints than MIN_MATCHES can never be matched.
+        # The rest are visited largest first, so that the larger (more
+        # informative) clusters take precedence in the overlap check.
+        cluster_sizes = np.bincount(cluster_labels[cluster_labels >= 0], minlength=n_clusters)
+        cluster_order = np.argsort(-cluster_sizes, kind='stable')
+        cluster_order = cluster_order[cluster_sizes[cluster_order] >= MIN_MATCHES]
+
+        cluster_matches = []
+        for ic in cluster_order:
+            in_cluster, = np.where(match_clusters == ic)
+            if len(in_cluster) < MIN_MATCHES:
+                continue
+            cluster_matches.append(tuple(array[in_cluster] for array in matches))
+
+        # Clusters are independent, and openCV releases the GIL while
+        # searching for homographies, so they are processed in parallel.
+        find_candidates = partial(self.cluster_candidates, target,
+                                  MIN_MATCHES=MIN_MATCHES, MIN_INLIERS=MIN_INLIERS)
+        if max_workers is None:
+            max_workers = self.max_workers
+        if max_workers == 1:
+            candidates = list(map(find_candidates, cluster_matches))
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+                candidates = list(executor.map(find_candidates, cluster_matches))
+        return self.select_non_overlapping(candidates)
 
-        # Loop over clusters
+    def detect_objects_coarse_to_fine(self, target_image, SCALE=0.5, MARGIN=0.25,
+                                      QUANTILE=0.02, MIN_MATCHES=10, MIN_INLIERS=10,
+                                      COARSE_MIN_MATCHES=5, COARSE_MIN_INLIERS=5):
+        """
+            As `detect_objects`, but first searches a copy of the target image
+            downscaled by `SCALE`. Each object found in this coarse pass is
+            then searched for again at full resolution, in the region around
+            its bounding-box (padded by `MARGIN` times the box dimensions on
+            each side), with all keypoints of the region matched as a single
+            cluster. Only these regions are searched at full resolution, so
+            large images containing few objects are processed far faster.
+
+            SIFT features are scale-invariant, so the full-resolution templates
+            are used in both passes. The downscaled image yields fewer
+            keypoints, so the coarse pass uses the looser thresholds
+            `COARSE_MIN_MATCHES` and `COARSE_MIN_INLIERS`.
+        """
+        small_image = cv2.resize(target_image, None, fx=SCALE, fy=SCALE,
+                                 interpolation=cv2.INTER_AREA)
+        coarse_objects = self.detect_objects(small_image, QUANTILE=QUANTILE,
+                                             MIN_MATCHES=COARSE_MIN_MATCHES,
+                                             MIN_INLIERS=COARSE_MIN_INLIERS)
+
+        height, width = target_image.shape[:2]
+        candidates = []
+        for coarse_object in coarse_objects:
+            # Full-resolution search region around the coarse bounding-box
+            x1, y1, x2, y2 = validation.vertices_to_AABB(coarse_object.bounding_box) / SCALE
+            pad_x, pad_y = MARGIN*(x2 - x1), MARGIN*(y2 - y1)
+            x1, y1 = max(0, int(x1 - pad_x)), max(0, int(y1 - pad_y))
+            x2, y2 = min(width, int(np.ceil(x2 + pad_x))), min(height, int(np.ceil(y2 + pad_y)))
+            if x2 <= x1 or y2 <= y1:
+                continue
+            # The region holds a single object, so its keypoints are matched
+            # as one cluster. Clustering the few keypoints of a small region
+            # would split the object.
+            region = target_image[y1:y2, x1:x2]
+            keypoints, descriptors = self.finder.detectAndCompute(region, None)
+            if descriptors is None:
+                continue
+            target = kpm.build_keypoint_set(region, keypoints, self._quantize(descriptors))
+            region_objects = self.cluster_candidates(target, self.match_templates(target),
+                                                     MIN_MATCHES, MIN_INLIERS)
+            # Keep only refinements of the coarse detection, in image coordinates
+            offset = np.array([x1, y1], dtype=np.int32)
+            candidates.append([DetectedObject(iobject.label, iobject.bounding_box + offset)
+                               for iobject in region_objects
+                               if iobject.label == coarse_object.label])
+        return self.select_non_overlapping(candidates)
+
+    def select_non_overlapping(self, candidates):
+        """
+            Takes a list containing, for each cluster, a list of candidate
+            `DetectedObject`s in order of preference. For each cluster accepts
+            the first candidate that does not significantly overlap an already
+            accepted object. Returns the list of accepted objects.
+        """
         detected_objects = []
-        for ic in range(n_clusters):
-            # Loop over trained samples
-            for il in range(n_labels):
-                template = self.templates[il]
-                label    = self.labels[il]
-                # Attempt to determine a matched-bounding box on the target image
-                cluster = kpm.KeypointSet(target_image, kp_clusters[ic], ds_clusters[ic])
-                bounding_box = kpm.get_matching_boundingbox(template, cluster, self.matcher,
-                                                            MIN_MATCHES=10, MIN_INLIERS=10)
-                # If a bounding box is found, check that it does not significantly overlap
-                # an existing detected object.
-                if bounding_box is not None:
-                    new_object = DetectedObject(label, bounding_box)
-                    if self.verify_non_overlapping(detected_objects, new_object) is True:
-                        detected_objects.append(new_object)
-                        break
+        detected_aabbs = np.empty((0, 4))  # AABBs of the detected objects
+        detected_areas = np.empty(0)       # Areas of the detected AABBs
+        for cluster_objects in candidates:
+            for new_object in cluster_objects:
+                new_aabb = validation.vertices_to_AABB(new_object.bounding_box)
+                if self.verify_non_overlapping(detected_aabbs, detected_areas, new_aabb) is True:
+                    detected_objects.append(new_object)
+                    detected_aabbs = np.vstack([detected_aabbs, new_aabb])
+                    detected_areas = np.append(detected_areas,
+                                               validation.compute_rectangle_area(new_aabb))
+                    break
         return detected_objects
@@ -1,6 +1,10 @@
+import re
 import pandas as pd
 from IPython.display import HTML
 
+# Matches the indentation at the start of each line
+_LSTRIP_RE = re.compile(r'(?m)^[ \t]+')
+
 
 # Formatting for tables
 # Original source: Eric Moyer (https://github.com/epmoyer/ipy_table/issues/24)
@@ -19,12 +23,10 @@ def multi_table(_table_list_, captions=None):
             captioned_tables.append((table_list[i].style.set_caption(captions[i])))
         table_list = captioned_tables
 
-    # This is required to get captions rendering on GitHub
+    # Stripping indentation is required to get captions rendering on GitHub
     # See: https://github.com/airbnb/knowledge-repo/issues/250
-    html = []
-    for table in table_list:
-        table_html = '\n'.join([line.lstrip() for line in table.render().split('\n')])
-        html.append(table_html)
+    # Uncaptioned DataFrames are rendered directly, without a Styler.
+    html = [_LSTRIP_RE.sub('', table.to_html()) for table in table_list]
 
     return HTML(
         '<table><tr style="background-color:white;">' +
@@ -38,14 +40,13 @@ def metadata_count_summary(md):
     summary dataframe counting the number of 'ok' and 'junk' images within the
     dataset, broken down brand-by-brand. The resulting dataframe is arranged to
     mimic the summary tables on the BelgaLogos website."""
-    # Perform image counts (total, ok images and junk images)
-    total_images = md['brand'].value_counts()
-    ok_images    = md[md.ok]['brand'].value_counts()
-    junk_images  = md[md.ok == False]['brand'].value_counts()
-
-    # Build a dataframe of image counts from the input dataset
-    summary = pd.concat([ok_images, junk_images, total_images], axis=1, sort=True)
-    summary.columns = ['#OK', '#Junk', 'Total']
+    # Perform image counts (ok images and total) in a single pass over brands
+    summary = md.groupby('brand', sort=True)['ok'].agg(['sum', 'size'])
+    summary.columns = ['#OK', 'Total']
+    summary['#Junk'] = summary['Total'] - summary['#OK']
+
+    # Arrange as on the BelgaLogos website
+    summary = summary[['#OK', '#Junk', 'Total']]
     summary.index.name = 'Logo name'
     return summary
 
@@ -53,9 +54,10 @@ def metadata_count_summary(md):
 def compute_bb_properties(md):
     """ Given an input DataFrame consisting of BelgaLogo metadata, compute
     general properties (width, height, size) of the associated bounding-boxes. """
-    image_widths  = md.apply(lambda row: row['bbx2'] - row['bbx1'], axis=1)
-    image_heights = md.apply(lambda row: row['bby2'] - row['bby1'], axis=1)
+    image_widths  = md['bbx2'].values - md['bbx1'].values
+    image_heights = md['bby2'].values - md['bby1'].values
     image_area  = image_widths * image_heights
-    image_properties = pd.concat([image_widths, image_heights, image_area], axis = 1)
-    image_properties.columns = ['Width', 'Height', 'Area']
+    image_properties = pd.DataFrame({'Width': image_widths,
+                                     'Height': image_heights,
+                                     'Area': image_area}, index=md.index)
     return image_properties
@@ -5,6 +5,11 @@ import numpy as np
 import pandas as pd
 import cv2
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+# Number of decoded images kept in memory by `read_image`
+IMAGE_CACHE_SIZE = 256
 
 
 def metadata_to_AABB(md):
@@ -14,12 +19,19 @@ def metadata_to_AABB(md):
 
 
 def vertices_to_AABB(points):
-    """ Computes the axis-aligned bounding-box of a list of 2D points,
-        returns [x1, y1, x2, y2] """
+    """ Computes the axis-aligned bounding-box of a list of 2D points (in any
+        shape flattening to (N,2), e.g openCV's (N,1,2)), returns an array
+        [x1, y1, x2, y2] """
+    points = np.ascontiguousarray(points).reshape(-1, 2)
+    return np.concatenate([points.min(axis=0), points.max(axis=0)])
+
 
-    minx, miny = np.min(points, axis=0)
-    maxx, maxy = np.max(points, axis=0)
-    return [minx, miny, maxx, maxy]
+def vertices_to_AABBs(polygons):
+    """ Computes the axis-aligned bounding-boxes of a list of N polygons with
+        equal vertex counts in a single pass, returns an (N,4) array of
+        [x1, y1, x2, y2] rows """
+    points = np.asarray(polygons)
+    return np.concatenate([points.min(axis=1), points.max(axis=1)], axis=1)
 
 
 def compute_rectangle_area(r):
@@ -56,51 +68,112 @@ def validate_detected_objects(metadata, detected_objects):
     """
     # List of bools, specifying if each detected object matches a corresponding annotation
     successful_match = [False] * len(detected_objects)
+    if len(detected_objects) == 0:
+        return successful_match
+
+    # For now use the axis-aligned bounding box for overlap detection
+    # The bounding-boxes in DetectedObject are in the format of vertices.
+    detected = vertices_to_AABBs([iobject.bounding_box for iobject in detected_objects])
+    detected_area = (detected[:, 2] - detected[:, 0])*(detected[:, 3] - detected[:, 1])
+
+    # True bounding-boxes of each brand, as [x1, y1, x2, y2] rows
+    aabb_columns = ['bbx1', 'bby1', 'bbx2', 'bby2']
+    truth_by_brand = {brand: group[aabb_columns].to_numpy()
+                      for brand, group in metadata.groupby('brand', sort=False)}
+
     for io, iobject in enumerate(detected_objects):
-        # For now use the axis-aligned bounding box for overlap detection
-        # The bounding-boxes in DetectedObject are in the format of vertices.
-        detected = vertices_to_AABB(iobject.bounding_box)
-        detected_area = compute_rectangle_area(detected)
         # Find matching-brand labels
-        true_labels = metadata[metadata.brand == iobject.label]
-        for index, true_annotation in true_labels.iterrows():
-            itruth  = metadata_to_AABB(true_annotation)
-            overlap = compute_rectangle_intersection(detected, itruth)
-            # At least 20% of the detected area must overlap with
-            # the true bounding-box to be matched
-            if overlap > 0.2*detected_area:
-                successful_match[io] = True
-                break
+        truth = truth_by_brand.get(iobject.label)
+        if truth is None:
+            continue
+        # Intersection of the detected box with every true box at once
+        olx = np.maximum(0, np.minimum(detected[io, 2], truth[:, 2]) - np.maximum(detected[io, 0], truth[:, 0]))
+        oly = np.maximum(0, np.minimum(detected[io, 3], truth[:, 3]) - np.maximum(detected[io, 1], truth[:, 1]))
+        overlap = olx * oly
+        # At least 20% of the detected area must overlap with
+        # the true bounding-box to be matched
+        successful_match[io] = bool(np.any(overlap > 0.2*detected_area[io]))
     return successful_match
 
 
-def study_matches(metadata, model):
+@lru_cache(maxsize=IMAGE_CACHE_SIZE)
+def read_image(filename):
+    """
+        Reads an openCV image, keeping recently read images in memory so that
+        repeated validation runs (e.g over several models) decode each image
+        only once. If a pre-decoded copy of the image (see
+        `convert_images_to_npy`) is present, it is memory-mapped instead. The
+        returned images are shared between callers and should not be modified.
+    """
+    npy_filename = os.path.splitext(filename)[0] + ".npy"
+    if os.path.exists(npy_filename):
+        return np.load(npy_filename, mmap_mode='r')
+    return cv2.imread(filename)
+
+
+def convert_images_to_npy(folder=os.path.join("data", "images")):
+    """
+        Writes a decoded copy `image.npy` of each `image.jpg` in `folder`, to
+        be memory-mapped by `read_image` rather than decoded on every read.
+    """
+    for filename in os.listdir(folder):
+        stem, extension = os.path.splitext(filename)
+        if extension.lower() != ".jpg":
+            continue
+        image = cv2.imread(os.path.join(folder, filename))
+        if image is not None:
+            np.save(os.path.join(folder, stem + ".npy"), image)
+
+
+def study_image(image, image_metadata, model, **detect_kwargs):
+    """
+        Runs a matching model over a single BelgaLogos image (specified by its
+        filename) and validates the detected objects against the image's
+        metadata (`image_metadata`, the rows of the full metadata for this
+        image). Any `detect_kwargs` are passed on to the model's
+        `detect_objects`. Returns the counts of actual positives, true
+        positives and false positives in the image.
+    """
+    # Read the image file
+    test_image = read_image(os.path.join("data", "images", image))
+
+    # Run the model over the image and validate the results with the above algorithm
+    detected_objects = model.detect_objects(test_image, **detect_kwargs)
+    correct_matches = validate_detected_objects(image_metadata, detected_objects)
+
+    n_correct = int(np.sum(correct_matches))
+    return len(image_metadata.index), n_correct, len(correct_matches) - n_correct
+
+
+def study_matches(metadata, model, n_jobs=None):
     """
         For a provided list of image metadata and a matching model, count the
         number of true and false positives detected in the images.  Returns a
         pandas Series.
+
+        Images are processed concurrently by `n_jobs` threads (by default, the
+        CPU count). The heavy lifting happens in openCV, which releases the
+        GIL. To avoid oversubscribing the CPU, models that bound their own
+        per-image threading (through a `max_workers` attribute, as
+        `KeypointMatcher`) are then run single-threaded on each image.
+        openCV's internal threading can further be limited by the caller with
+        `cv2.setNumThreads`.
     """
-    # Initialise counts
-    true_positives   = 0
-    actual_positives = 0
-    false_positives  = 0
-    image_count      = 0
-
-    unique_images = metadata["image_file"].unique()
-    for image in unique_images:
-        # Fetch corresponding metadata for this image
-        image_metadata = metadata[metadata["image_file"] == image]
-        # Read the image file
-        test_image = cv2.imread(os.path.join("data", "images", image))
-
-        # Run the model over the image and validate the results with the above algorithm
-        detected_objects = model.detect_objects(test_image)
-        correct_matches = validate_detected_objects(image_metadata, detected_objects)
-
-        actual_positives += len(image_metadata.index)
-        true_positives   += np.sum(correct_matches)
-        false_positives  += len(correct_matches) - np.sum(correct_matches)
-        image_count += 1
+    # Partition the metadata by image in a single pass
+    image_groups = metadata.groupby("image_file", sort=False)
+    if n_jobs == 1:
+        counts = [study_image(*group, model) for group in image_groups]
+    else:
+        detect_kwargs = {"max_workers": 1} if hasattr(model, "max_workers") else {}
+        with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as executor:
+            counts = list(executor.map(lambda group: study_image(*group, model, **detect_kwargs),
+                                       image_groups))
+
+    # Sum the counts over all images
+    actual_positives = sum(count[0] for count in counts)
+    true_positives   = sum(count[1] for count in counts)
+    false_positives  = sum(count[2] for count in counts)
+    image_count      = len(counts)
 
     count_dict = { "true_positives": true_positives,
                    "actual_positives": actual_positives,
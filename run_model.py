@@ -1,7 +1,31 @@
 #!/usr/bin/env python3
 import lib.model as kpm
 import argparse
-import json, os, cv2, sys
+import json, os, re, cv2, sys, warnings
+
+# Directory in which template keypoints are cached between runs
+TEMPLATE_CACHE = os.path.join("data", "template_cache")
+
+
+def opencv_baseline_features():
+    """
+        Returns the list of CPU features in openCV's baseline, i.e those that
+        all of openCV's code is compiled for. Features which are only
+        dispatched at runtime (e.g AVX2 in the stock x86 wheels) are not
+        included.
+    """
+    baseline = re.search(r'^\s*Baseline:(.*)$', cv2.getBuildInformation(), re.MULTILINE)
+    return baseline.group(1).split() if baseline is not None else []
+
+
+def check_opencv_build():
+    """
+        Warns if openCV was not built with an AVX2 baseline, in which case SIFT
+        runs considerably slower (see scripts/build_opencv.sh).
+    """
+    if 'AVX2' not in opencv_baseline_features():
+        warnings.warn("OpenCV was built without an AVX2 baseline, keypoint detection will be slow. "
+                      "See scripts/build_opencv.sh for building an optimised OpenCV.")
 
 
 def train_model_on_logos(model, logo_selection):
@@ -13,12 +37,15 @@ def train_model_on_logos(model, logo_selection):
     logo_registration_path = os.path.join("data", logo_selection, "registered_logos.json")
     with open(logo_registration_path) as json_file:
         data = json.load(json_file)
-        for logo in data:
+        # Each logo is registered once, even if listed several times
+        for logo in dict.fromkeys(data):
             # Get the logo image
             logo_filename = os.path.join("data", logo_selection, logo.lower() + '.jpg')
             logo_image = cv2.imread(logo_filename)
             # Train the matcher on the image
             model.add_template(logo, logo_image)
+    # Build the matcher index over all templates
+    model.train()
 
 
 def annotate_image(model, test_image):
@@ -35,19 +62,32 @@ def annotate_image(model, test_image):
     return annotated_image
 
 
-def main(source, test_images):
+def build_model(detector):
+    """
+        Builds an untrained KeypointMatcher using the keypoint finder named by
+        `detector`. ORB descriptors are binary, and are matched with the
+        Hamming distance (a popcount) rather than the floating-point L2 distance
+        used for SIFT, trading some accuracy for speed.
+    """
+    if detector == "orb":
+        ORB = cv2.ORB_create(nfeatures=1000)
+        return kpm.KeypointMatcher(ORB, cv2.NORM_HAMMING, cache_dir=TEMPLATE_CACHE)
+    SIFT = cv2.xfeatures2d.SIFT_create()
+    return kpm.KeypointMatcher(SIFT, cv2.NORM_L2SQR, cache_dir=TEMPLATE_CACHE)
+
+
+def main(source, test_images, detector="sift"):
     print("Training...")
 
     # Initialise model
-    SIFT = cv2.xfeatures2d.SIFT_create()
-    SIFTMatcher = kpm.KeypointMatcher(SIFT, cv2.NORM_L2SQR)
-    train_model_on_logos(SIFTMatcher, source)
+    model = build_model(detector)
+    train_model_on_logos(model, source)
     print("Training complete")
 
     print("Detecting logos...")
     for filename in test_images:
         test_image = cv2.imread(filename)
-        result_image = annotate_image(SIFTMatcher, test_image)
+        result_image = annotate_image(model, test_image)
         result_filename = "annotated_" + os.path.basename(filename)
         cv2.imwrite(result_filename, result_image)
         print(" Exported", result_filename)
@@ -58,5 +98,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('template_source', help="choice of source templates", choices=['logos', 'live_logos'])
     parser.add_argument('images', help="list of input images", nargs='*')
+    parser.add_argument('--detector', help="choice of keypoint detector", choices=['sift', 'orb'], default='sift')
     args = parser.parse_args()
-    main(args.template_source, args.images)
+    check_opencv_build()
+    main(args.template_source, args.images, args.detector)